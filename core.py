@@ -3,13 +3,48 @@ Multi-version dropdown updater.
 """
 
 import argparse
+import copy
+import functools
+import hashlib
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from lxml import etree, html
+from lxml import etree
 from packaging.version import InvalidVersion, Version
 
+# Shared parser for pkgdown pages, which are always UTF-8 encoded. Element IDs
+# are never looked up, so the ID hash table is not built.
+_PARSER = etree.HTMLParser(encoding="utf-8", collect_ids=False, huge_tree=True)
+
+# XPath expressions are compiled once at import and reused for every HTML file.
+_NAVBAR_XP = etree.XPath(
+    "//div[@id='navbar']//ul["
+    "contains(concat(' ', normalize-space(@class), ' '), ' navbar-nav ') and "
+    "contains(concat(' ', normalize-space(@class), ' '), ' me-auto ')]"
+)
+_NAV_ITEMS_XP = etree.XPath(
+    './/li[contains(concat(" ", normalize-space(@class), " "), " nav-item ")]'
+)
+_EXISTING_DROPDOWN_XP = etree.XPath('.//li[div/@aria-labelledby="dropdown-versions"]')
+
+# Written ahead of the serialized <html> element of every processed page.
+_PROLOG = (
+    b"<!DOCTYPE html>\n"
+    b"<!-- Generated by pkgdown + "
+    b"https://github.com/insightsengineering/r-pkgdown-multiversion -->\n"
+)
+
+# Buffer size used when writing files; pkgdown pages are often hundreds of KiB.
+_BUFFER_SIZE = 1 << 20
+
+# Number of HTML files handed to a worker process at a time.
+_CHUNKSIZE = 16
+
+# Drop-down list element of the current worker process, see _worker_init.
+_VERSIONS_DROPDOWN = None
+
 
 def compile_pattern(pattern):
     """
@@ -29,11 +64,12 @@ def find_matching_directories(directory, regex):
     :param regex: Compiled regular expression pattern to match directory names.
     :return: List of matching directories.
     """
-    return [
-        d
-        for d in os.listdir(directory)
-        if os.path.isdir(os.path.join(directory, d)) and regex.match(d)
-    ]
+    with os.scandir(directory) as entries:
+        return [
+            entry.name
+            for entry in entries
+            if entry.is_dir() and regex.match(entry.name)
+        ]
 
 
 def separate_refs(matching_dirs, refs_order):
@@ -44,14 +80,18 @@ def separate_refs(matching_dirs, refs_order):
     :param refs_order: List determining the order of items to appear at the beginning.
     :return: Tuple of ordered_refs and remaining_refs.
     """
-    ordered_refs = [d for d in refs_order if d in matching_dirs]
-    remaining_refs = [d for d in matching_dirs if d not in refs_order]
+    matching_set = set(matching_dirs)
+    order_set = set(refs_order)
+    ordered_refs = [d for d in refs_order if d in matching_set]
+    remaining_refs = [d for d in matching_dirs if d not in order_set]
     return ordered_refs, remaining_refs
 
 
+@functools.lru_cache(maxsize=4096)
 def sorting_key(ref):
     """
     Define a custom sorting key function.
+    Results are cached, as parsing a Version is comparatively expensive.
 
     :param ref: Reference to be sorted.
     :return: Tuple for sorting.
@@ -85,47 +125,35 @@ def generate_refs_dict(ordered_refs, base_url):
     return {ref: f"{base_url}{ref}" for ref in ordered_refs}
 
 
-def generate_markup(ordered_refs, refs_dict):
+def generate_dropdown_hash(ordered_refs, refs_dict):
     """
-    Generate the HTML markup for the drop-down list.
+    Generate a short digest identifying the contents of the drop-down list.
 
     :param ordered_refs: List of ordered references.
     :param refs_dict: Dictionary of references and their URLs.
-    :return: str, Generated HTML markup.
-    """
-    nav_item = """
-    <li class="nav-item dropdown">
-    <a href="#" class="nav-link dropdown-toggle"
-        data-bs-toggle="dropdown" role="button"
-        aria-expanded="false" aria-haspopup="true"
-        id="dropdown-versions">Versions</a>
-    <div class="dropdown-menu" aria-labelledby="dropdown-versions">
+    :return: str, Hexadecimal digest.
     """
+    digest = hashlib.blake2b(digest_size=8)
     for ref in ordered_refs:
-        nav_item += '<a class="dropdown-item" data-toggle="tooltip" title="" '
-        nav_item += f'href="{refs_dict[ref]}">{ref}</a>\n'
-    nav_item += "</div></li>"
-    return nav_item
+        digest.update(f"{ref}\0{refs_dict[ref]}\n".encode("utf-8"))
+    return digest.hexdigest()
 
 
-def generate_dropdown_list(directory, pattern, refs_order, base_url):
+def generate_dropdown_list(matching_dirs, refs_order, base_url):
     """
     Generates version drop-down list to be inserted based
-    on matching directories in the given directory and refs_order.
+    on matching directories and refs_order.
 
-    :param directory: The root directory to search for matching directories.
-    :param pattern: A regular expression pattern to match directory names.
+    :param matching_dirs: List of matching directories.
     :param refs_order: List determining the order of items to appear at the beginning.
     :param base_url: The base URL to be used in the hrefs.
-    :return: str, Generated HTML markup.
+    :return: Tuple of ordered_refs and refs_dict.
     """
-    regex = compile_pattern(pattern)
-    matching_dirs = find_matching_directories(directory, regex)
     ordered_refs, remaining_refs = separate_refs(matching_dirs, refs_order)
     remaining_refs = sort_remaining_refs(remaining_refs)
     ordered_refs.extend(remaining_refs)
     refs_dict = generate_refs_dict(ordered_refs, base_url)
-    return generate_markup(ordered_refs, refs_dict)
+    return ordered_refs, refs_dict
 
 
 def find_navbar(tree):
@@ -135,9 +163,7 @@ def find_navbar(tree):
     :param tree: lxml HTML tree object.
     :return: First <ul> element with class 'navbar-nav' or None.
     """
-    navbar = tree.xpath(
-        "//div[@id='navbar']//ul[contains(@class, 'navbar-nav') and contains(@class, 'me-auto')]"
-    )
+    navbar = _NAVBAR_XP(tree)
     if not navbar:
         print(
             "No <ul> element with class 'navbar-nav' found in the document.",
@@ -154,85 +180,102 @@ def find_navbar_items(navbar):
     :param navbar: The navbar.
     :return: List of <li> elements.
     """
-    if navbar or navbar is not None:
-        return navbar.xpath('.//li[contains(@class, "nav-item")]')
+    if navbar is not None:
+        return _NAV_ITEMS_XP(navbar)
     return []
 
 
-def create_versions_dropdown(dropdown_list):
+def create_versions_dropdown(ordered_refs, refs_dict):
     """
-    Create a new element from the drop-down list markup.
+    Create the drop-down list element. The element is built directly
+    rather than by parsing HTML markup.
 
-    :param dropdown_list: str, HTML markup containing the drop-down list to insert.
-    :return: Custom element or None.
+    :param ordered_refs: List of ordered references.
+    :param refs_dict: Dictionary of references and their URLs.
+    :return: <li> element containing the drop-down list.
     """
-    try:
-        return html.fromstring(dropdown_list, parser=etree.HTMLParser())
-    except Exception as e:
-        print(f"Error parsing the drop-down list: {e}", file=sys.stderr)
-        return None
+    dropdown_hash = generate_dropdown_hash(ordered_refs, refs_dict)
+    nav_item = etree.Element(
+        "li", {"class": "nav-item dropdown", "data-versions-hash": dropdown_hash}
+    )
+    nav_item.text = "\n"
+    toggle = etree.SubElement(
+        nav_item,
+        "a",
+        {
+            "href": "#",
+            "class": "nav-link dropdown-toggle",
+            "data-bs-toggle": "dropdown",
+            "role": "button",
+            "aria-expanded": "false",
+            "aria-haspopup": "true",
+            "id": "dropdown-versions",
+        },
+    )
+    toggle.text = "Versions"
+    toggle.tail = "\n"
+    menu = etree.SubElement(
+        nav_item,
+        "div",
+        {"class": "dropdown-menu", "aria-labelledby": "dropdown-versions"},
+    )
+    menu.text = "\n"
+    for ref in ordered_refs:
+        item = etree.SubElement(
+            menu,
+            "a",
+            {
+                "class": "dropdown-item",
+                "data-toggle": "tooltip",
+                "title": "",
+                "href": refs_dict[ref],
+            },
+        )
+        item.text = ref
+        item.tail = "\n"
+    return nav_item
 
 
-def insert_versions_dropdown(tree, dropdown_list):
+def insert_versions_dropdown(tree, versions_dropdown):
     """
     Inserts the drop-down list into the navbar.
 
     :param tree: lxml HTML tree object.
-    :param dropdown_list: str, HTML markup containing the drop-down list to insert.
+    :param versions_dropdown: Drop-down list element to insert. The element is
+        moved into the tree, so callers should pass a copy when reusing it.
     :return: bool, True if successful, False otherwise.
     """
     navbar = find_navbar(tree)
-    if not navbar:
+    if navbar is None:
         return False  # No navbar found
 
     navbar_items = find_navbar_items(navbar)
     if not navbar_items:
         return False  # No navbar items found
 
-    versions_dropdown = create_versions_dropdown(dropdown_list)
-    if not versions_dropdown:
-        return False  # Failed to create dropdown
-
-    # Find all <li> that contain a <div> with aria-labelledby="dropdown-versions"
-    existing_dropdown = navbar.xpath('.//li[div/@aria-labelledby="dropdown-versions"]')
-
-    # If no existing dropdown is found, add the new dropdown to the end of the navbar
-    if not existing_dropdown:
-        new_li = html.Element("div")
-        new_li.append(versions_dropdown)  # Append the new dropdown directly
-
-        # Append the new <li> to the last <li> item in the navbar
-        navbar[-1].addnext(new_li)
-        return True
-
-    # Remove duplicates by keeping track of IDs or contents
-    existing_ids = set()
-    for item in existing_dropdown:
-        dropdown_id = item.get("id")  # or another identifier if necessary
-        if dropdown_id not in existing_ids:
-            existing_ids.add(dropdown_id)
-        else:
-            # Remove the duplicate
-            item.getparent().remove(item)
-
-    # Replace the first remaining existing dropdown with the new versions_dropdown
-    if existing_dropdown:
-        existing_dropdown[0].getparent().replace(
-            existing_dropdown[0], versions_dropdown
-        )
+    # Remove all <li> that contain a <div> with aria-labelledby="dropdown-versions"
+    for item in _EXISTING_DROPDOWN_XP(navbar):
+        parent = item.getparent()
+        parent.remove(item)
+        # Previous versions wrapped the drop-down list in a <div>
+        if parent.tag == "div" and len(parent) == 0 and not (parent.text or "").strip():
+            parent.getparent().remove(parent)
 
+    # Add the new dropdown to the end of the navbar
+    navbar.append(versions_dropdown)
     return True
 
 
 def read_file(file_path):
     """
-    Read the content of a file.
+    Read the raw content of a file.
 
     :param file_path: Path to the file.
-    :return: Content of the file or None.
+    :return: bytes, Content of the file or None.
     """
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
+        # Unbuffered: the whole file is read at once, sized from fstat.
+        with open(file_path, "rb", buffering=0) as f:
             return f.read()
     except FileNotFoundError:
         print(f"Error: The file '{file_path}' was not found.", file=sys.stderr)
@@ -248,17 +291,20 @@ def read_file(file_path):
     return None
 
 
-def write_file(file_path, content):
+def _write_atomically(file_path, write):
     """
-    Write content to a file.
+    Write a file through a temporary file which then replaces the target,
+    so a failed write never leaves it truncated.
 
     :param file_path: Path to the file.
-    :param content: Content to write.
+    :param write: Callable writing the content into the given binary file object.
     :return: bool, True if successful, False otherwise.
     """
+    tmp_path = f"{file_path}.tmp"
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        with open(tmp_path, "wb", buffering=_BUFFER_SIZE) as f:
+            write(f)
+        os.replace(tmp_path, file_path)
         return True
     except PermissionError:
         print(
@@ -270,68 +316,159 @@ def write_file(file_path, content):
             f"An unexpected error occurred while writing to the file '{file_path}': {e}",
             file=sys.stderr,
         )
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
     return False
 
 
-def process_single_html_file(file_path, dropdown_list):
+def write_file(file_path, content):
+    """
+    Write raw content to a file.
+
+    :param file_path: Path to the file.
+    :param content: bytes, Content to write.
+    :return: bool, True if successful, False otherwise.
+    """
+    return _write_atomically(file_path, lambda f: f.write(content))
+
+
+def write_html_file(file_path, tree):
+    """
+    Write a processed HTML page to a file. The page is serialized straight
+    into the file rather than into an intermediate bytes object.
+
+    :param file_path: Path to the file.
+    :param tree: lxml HTML tree object.
+    :return: bool, True if successful, False otherwise.
+    """
+
+    def write(f):
+        f.write(_PROLOG)
+        with etree.htmlfile(f, encoding="utf-8") as xf:
+            xf.write(tree)
+
+    return _write_atomically(file_path, write)
+
+
+def process_single_html_file(file_path, versions_dropdown):
     """
     Process a single HTML file, inserting a dropdown list after the last <li> element.
 
     :param file_path: Path to the HTML file.
-    :param dropdown_list: HTML content for the dropdown list.
+    :param versions_dropdown: Drop-down list element to insert (copied).
     :return: bool, True if successful, False otherwise.
     """
     html_contents = read_file(file_path)
     if html_contents is None:
         return False
 
+    # Skip parsing pages which already contain an identical drop-down list.
+    dropdown_hash = versions_dropdown.get("data-versions-hash")
+    if (
+        dropdown_hash
+        and f'data-versions-hash="{dropdown_hash}"'.encode("utf-8") in html_contents
+    ):
+        print(f"✅ {file_path} (up to date)")
+        return True
+
     try:
-        tree = html.fromstring(html_contents)
+        tree = etree.fromstring(html_contents, parser=_PARSER)
     except etree.XMLSyntaxError as e:
         print(f"Error parsing the HTML: {e}", file=sys.stderr)
         return False
+    if tree is None:
+        print(f"Error parsing the HTML: {file_path} is empty", file=sys.stderr)
+        return False
 
-    success = insert_versions_dropdown(tree, dropdown_list)
+    success = insert_versions_dropdown(tree, copy.deepcopy(versions_dropdown))
     if not success:
         print(f"❌ {file_path}", file=sys.stderr)
         return False
 
-    doctype = "<!DOCTYPE html>\n"
-    comment = "<!-- Generated by pkgdown + https://github.com/insightsengineering/r-pkgdown-multiversion -->\n"
-    html_content = etree.tostring(
-        tree, encoding="unicode", pretty_print=True, method="html"
-    )
-    modified_html = doctype + comment + html_content
-
-    if not write_file(file_path, modified_html):
+    if not write_html_file(file_path, tree):
         return False
 
     print(f"✅ {file_path}")
     return True
 
 
-def process_html_files_in_directory(directory, pattern, refs_order, base_url):
+def _iter_html(directory):
     """
-    Process all HTML files in the given directory,
-    inserting a dropdown list after the last <li> element.
+    Recursively yield the paths of HTML files in the given directory.
+    Like os.walk, symlinked directories are not descended into and
+    unreadable directories are skipped.
 
     :param directory: The root directory to search for HTML files.
-    :param pattern: Regular expression pattern to match directory names.
-    :param refs_order: List determining the order of items to appear at the beginning.
-    :param base_url: Base URL to be used in the hrefs.
+    :return: Generator of paths to HTML files.
+    """
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".html") and entry.is_file():
+                        yield entry.path
+        except OSError:
+            continue
+
+
+def _worker_init(ordered_refs, refs_dict):
     """
-    processed_files = set()
-    dropdown_list = generate_dropdown_list(directory, pattern, refs_order, base_url)
+    Initialize a worker process by creating the drop-down list element once.
+    lxml elements cannot be pickled, so each worker builds its own copy.
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".html"):
-                file_path = os.path.join(root, file)
-                if file_path in processed_files:
-                    continue
+    :param ordered_refs: List of ordered references.
+    :param refs_dict: Dictionary of references and their URLs.
+    """
+    global _VERSIONS_DROPDOWN
+    _VERSIONS_DROPDOWN = create_versions_dropdown(ordered_refs, refs_dict)
 
-                if process_single_html_file(file_path, dropdown_list):
-                    processed_files.add(file_path)
+
+def _process_html_file_worker(file_path):
+    """
+    Process a single HTML file in a worker process.
+
+    :param file_path: Path to the HTML file.
+    :return: bool, True if successful, False otherwise.
+    """
+    if _VERSIONS_DROPDOWN is None:
+        return False
+    return process_single_html_file(file_path, _VERSIONS_DROPDOWN)
+
+
+def process_html_files_in_directory(directory, version_dirs, ordered_refs, refs_dict):
+    """
+    Process all HTML files in the version directories of the given directory,
+    inserting a dropdown list after the last <li> element.
+
+    :param directory: The root directory containing the version directories.
+    :param version_dirs: List of directories whose HTML files should be processed.
+    :param ordered_refs: List of ordered references.
+    :param refs_dict: Dictionary of references and their URLs.
+    """
+    html_files = [
+        file_path
+        for version_dir in version_dirs
+        for file_path in _iter_html(os.path.join(directory, version_dir))
+    ]
+    if not html_files:
+        return
+
+    # Files are independent of each other, so they are spread across processes.
+    with ProcessPoolExecutor(
+        max_workers=min(os.cpu_count() or 1, len(html_files)),
+        initializer=_worker_init,
+        initargs=(ordered_refs, refs_dict),
+    ) as executor:
+        for _ in executor.map(
+            _process_html_file_worker, html_files, chunksize=_CHUNKSIZE
+        ):
+            pass
 
 
 def update_single_search_json(search_json_path, version, base_url):
@@ -347,8 +484,16 @@ def update_single_search_json(search_json_path, version, base_url):
     if file_content is None:
         return False
 
-    url_pattern = re.compile(rf"({re.escape(base_url)})(?!{re.escape(version)})")
-    updated_content = url_pattern.sub(f"{base_url}{version}/", file_content)
+    # Insert the version after every occurrence of the base URL
+    # which is not already followed by it.
+    needle = base_url.encode("utf-8")
+    version_bytes = version.encode("utf-8")
+    versioned = version_bytes + b"/"
+    chunks = file_content.split(needle)
+    for i in range(1, len(chunks)):
+        if not chunks[i].startswith(version_bytes):
+            chunks[i] = versioned + chunks[i]
+    updated_content = needle.join(chunks)
 
     if updated_content != file_content:
         if write_file(search_json_path, updated_content):
@@ -360,17 +505,14 @@ def update_single_search_json(search_json_path, version, base_url):
     return True
 
 
-def update_search_json_urls(directory, pattern, base_url):
+def update_search_json_urls(directory, matching_dirs, base_url):
     """
     Update the URLs in search.json files within the given directory to include the version.
 
     :param directory: The root directory to search for search.json files.
-    :param pattern: Regular expression pattern to match directory names.
+    :param matching_dirs: List of matching directories.
     :param base_url: Base URL to be used in the hrefs.
     """
-    regex = compile_pattern(pattern)
-    matching_dirs = find_matching_directories(directory, regex)
-
     for current_directory in matching_dirs:
         search_json_path = os.path.join(directory, current_directory, "search.json")
         if not os.path.isfile(search_json_path):
@@ -402,13 +544,30 @@ def main():
     parser.add_argument(
         "--base_url", required=True, help="Base URL to be used in the hrefs."
     )
+    parser.add_argument(
+        "--extra_dirs",
+        nargs="*",
+        default=[],
+        help="Additional directories whose HTML files should get the drop-down list "
+        "without being listed in it.",
+    )
 
     args = parser.parse_args()
 
+    regex = compile_pattern(args.pattern)
+    matching_dirs = find_matching_directories(args.directory, regex)
+    ordered_refs, refs_dict = generate_dropdown_list(
+        matching_dirs, args.refs_order, args.base_url
+    )
+    version_dirs = matching_dirs + [
+        d
+        for d in args.extra_dirs
+        if d not in matching_dirs and os.path.isdir(os.path.join(args.directory, d))
+    ]
     process_html_files_in_directory(
-        args.directory, args.pattern, args.refs_order, args.base_url
+        args.directory, version_dirs, ordered_refs, refs_dict
     )
-    update_search_json_urls(args.directory, args.pattern, args.base_url)
+    update_search_json_urls(args.directory, matching_dirs, args.base_url)
 
 
 if __name__ == "__main__":